@@ -1,16 +1,25 @@
+import asyncio
+import aiohttp
+import httpx
+import diskcache
 import requests
 from requests.exceptions import HTTPError, ConnectionError, Timeout
-from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
 import json
 import time
 import base64
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+from functools import lru_cache
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import os
+from urllib.parse import urlencode
 import logging
 import argparse
+from types import MappingProxyType
 
 parser = argparse.ArgumentParser(description="A script to automatically build your Anki flashcards.")
 parser.add_argument('--language', type=str, choices=['en', 'cn'], 
@@ -23,6 +32,33 @@ logging.basicConfig(level=logging.INFO)
 # AnkiConnect URL
 ANKI_CONNECT_URL = 'http://localhost:8765'
 
+# How many dictionary lookups and audio downloads run at once
+MAX_CONCURRENT_LOOKUPS = 16
+MAX_CONCURRENT_DOWNLOADS = 32
+
+# Connection limits for the audio download session
+MAX_DOWNLOAD_CONNECTIONS = 64
+MAX_DOWNLOAD_CONNECTIONS_PER_HOST = 16
+
+# Retries for audio downloads whose connection is refused or reset, backing off 0.5s, 1s, 2s
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+
+# Persistent cache for Cambridge lookups and downloaded audio
+CACHE = diskcache.Cache(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cambridge_cache'))
+CACHE_EXPIRE = 86400 * 30  # 30 days
+
+# How many notes' AnkiConnect actions are sent together in one "multi" request
+ANKI_BATCH_SIZE = 25
+# ...and how much base64 audio one "multi" request may carry before it is sent early
+ANKI_BATCH_BYTES = 2 * 1024 * 1024
+
+# Pooled session for the synchronous AnkiConnect calls
+SESSION = requests.Session()
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.5))
+SESSION.mount('http://', adapter)
+SESSION.mount('https://', adapter)
+
 # VocalWare credentials
 API_ID = os.getenv('VW_API_ID')
 ACCOUNT_ID = os.getenv('VW_ACCOUNT_ID')
@@ -31,59 +67,78 @@ SECRET_PHRASE = os.getenv('VW_SECRET_PHRASE')
 if not API_ID or not ACCOUNT_ID or not SECRET_PHRASE:
     raise EnvironmentError("Missing VocalWare credentials!")
 
-# Function to get cards from a specific deck
-def get_cards(deck_name):
+# VocalWare voice: English UK, Hugh, Adult Male
+VW_EID = 3  # Engine ID
+VW_LID = 1  # Language ID
+VW_VID = 5  # Voice ID
+
+# Fixed parts of the VocalWare checksum around the word (the secret should NOT be URL-encoded)
+VW_HASH_PREFIX = f"{VW_EID}{VW_LID}{VW_VID}".encode()
+VW_HASH_SUFFIX = (ACCOUNT_ID + API_ID + SECRET_PHRASE).encode()
+
+# Cambridge Dictionary page layout per language (read-only)
+LANGUAGE_DICT = MappingProxyType({
+    'en': MappingProxyType({'uri':'english', 'tag':'div', 'class':'def ddef_d db'}),
+    'cn': MappingProxyType({'uri':'english-chinese-simplified', 'tag':'div', 'class':'tc-bb tb lpb-25 break-cj'}),
+})
+
+# Classes the definition and example elements must carry
+DEFINITION_CLASSES = {language: frozenset(layout['class'].split()) for language, layout in LANGUAGE_DICT.items()}
+EXAMPLE_CLASSES = frozenset(['examp', 'dexamp'])
+
+# Marks the start of each dictionary on a Cambridge page
+CAMBRIDGE_DICTIONARY_START = b'<div class="pr dictionary"'
+
+# Tags worth looking at on a Cambridge page: the audio source, the definition and the examples
+WORD_INFO_TAGS = {language: tuple({'source', layout['tag'], 'div'}) for language, layout in LANGUAGE_DICT.items()}
+
+# Function to get the notes in a specific deck whose Audio field is missing, empty or only whitespace
+def find_notes_without_audio(deck_name):
 
     payload = {
-        "action": "findCards",
+        "action": "findNotes",
         "version": 6,
         "params": {
-            "query": f"deck:{deck_name}"
+            # "Audio:" alone would only match an existing, exactly empty field, so exclude
+            # notes whose Audio has any non-whitespace character instead (needs Anki 2.1.24+)
+            "query": f'deck:"{deck_name}" -"Audio:re:\\S"'
         }
     }
     try:
-        response = requests.post(ANKI_CONNECT_URL, json=payload, timeout=5)
+        response = SESSION.post(ANKI_CONNECT_URL, json=payload, timeout=5)
         response.raise_for_status()
         response_data = response.json()
     except (HTTPError, ConnectionError, Timeout) as e:
-        logging.error(f"Failed to fetch data from {url}: {e}")
+        logging.error(f"Failed to fetch data from {ANKI_CONNECT_URL}: {e}")
+        return None
+    if response_data.get('error') is not None:
+        logging.error(f"Error finding notes without audio in deck '{deck_name}': {response_data['error']}")
         return None
     return response_data['result']
 
-# Function to get note details for cards
-def get_notes(cards):
+# Function to get note details for note IDs
+def get_notes(note_ids):
     payload = {
-        "action": "cardsInfo",
+        "action": "notesInfo",
         "version": 6,
         "params": {
-            "cards": cards
+            "notes": note_ids
         }
     }
-    response = requests.post(ANKI_CONNECT_URL, json=payload).json()
+    response = SESSION.post(ANKI_CONNECT_URL, json=payload).json()
+    if response.get('error') is not None:
+        logging.error(f"Error fetching {len(note_ids)} notes: {response['error']}")
+        return None
     return response['result']
 
+# Function to build the AnkiConnect action that fills in a note's fields
 def add_word_info_to_note(note_id, audio_file_name, definition, examples):
-    # Ensure note_id is an integer
-    if not isinstance(note_id, int):
-        print(f"Error: note_id must be an integer, got {type(note_id)} instead.")
-        return
-
-    # Ensure definition is a string (fallback to empty string if None)
-    if definition is None:
-        definition = ""
-    elif not isinstance(definition, str):
-        print(f"Error: definition must be a string, got {type(definition)} instead.")
-        return
-
-    # Ensure examples is a list of strings (fallback to empty string if None)
-    if examples is None:
-        examples_text = ""
-    elif isinstance(examples, list):
-        # Use <br> to insert HTML line breaks for Anki's rendering
-        examples_text = "<br>".join([str(example) for example in examples])
-    else:
-        print(f"Error: examples must be a list, got {type(examples)} instead.")
-        return
+    # Callers always pass an int note_id and a list of example strings (checked only without -O)
+    assert isinstance(note_id, int), f"note_id must be an integer, got {type(note_id)} instead."
+    assert isinstance(examples, list), f"examples must be a list, got {type(examples)} instead."
+    definition = definition or ""
+    # Use <br> to insert HTML line breaks for Anki's rendering
+    examples_text = "<br>".join(examples)
 
     # Debug: Check if field names are correct (especially "Extra information")
     # print(f"Updating note {note_id} with fields:")
@@ -91,8 +146,8 @@ def add_word_info_to_note(note_id, audio_file_name, definition, examples):
     # print(f"Definition: {definition}")
     # print(f"Extra information (Examples): {examples_text}")
 
-    # Construct payload for AnkiConnect
-    payload = {
+    # Construct action for AnkiConnect
+    return {
         "action": "updateNoteFields",
         "version": 6,
         "params": {
@@ -107,176 +162,241 @@ def add_word_info_to_note(note_id, audio_file_name, definition, examples):
         }
     }
 
-    # Send request to AnkiConnect
-    response = requests.post(ANKI_CONNECT_URL, json=payload).json()
-    if response.get('error') is not None:
-        logging.error(f"Error updating note {note_id}: {response['error']}")
-    else:
-        logging.info(f"Note {note_id} successfully updated.")
-    
-    # Debug: Print the full response to ensure AnkiConnect is receiving the request correctly
-    # print("AnkiConnect response:", response)
+# Cut a Cambridge page right before its second dictionary, everything we need is in the first one
+def cambridge_page_fragment(html):
+    first = html.find(CAMBRIDGE_DICTIONARY_START)
+    if first == -1:
+        return html
+    cutoff = html.find(CAMBRIDGE_DICTIONARY_START, first + len(CAMBRIDGE_DICTIONARY_START))
+    return html[:cutoff] if cutoff != -1 else html
+
+# HTML parser that decodes raw page bytes with the given encoding, built once per encoding
+@lru_cache(maxsize=None)
+def html_parser(encoding):
+    return lxml.html.HTMLParser(encoding=encoding)
+
+# Parse a Cambridge page and sort the matches into the audio tag, the definition and the examples
+def find_word_info_tags(html, encoding, language):
+    try:
+        root = lxml.html.fromstring(html, parser=html_parser(encoding))
+    except lxml.etree.ParserError:
+        # Empty or whitespace-only page, nothing to find
+        return None, None, []
+
+    # One walk over the tree that stops once the audio, the definition and three examples are found
+    audio_tag = None
+    definition_tag = None
+    example_tags = []  # Only keep the first three
+    for element in root.iter(*WORD_INFO_TAGS[language]):
+        if element.tag == 'source':
+            if audio_tag is None and element.get('type') == 'audio/mpeg':
+                audio_tag = element
+        else:
+            classes = set(element.get('class', '').split())
+            if definition_tag is None and DEFINITION_CLASSES[language] <= classes:
+                definition_tag = element
+            elif len(example_tags) < 3 and EXAMPLE_CLASSES <= classes:
+                example_tags.append(element)
+        if audio_tag is not None and definition_tag is not None and len(example_tags) == 3:
+            break
+    return audio_tag, definition_tag, example_tags
 
 # Function to get TTS audio URL from Cambridge Dictionary
-def get_cambridge_word_info(word, language):
+async def get_cambridge_word_info(client, word, language):
     # Replace spaces with hyphens for the search URL
     formatted_word = word.replace(' ', '-')
 
-    language_dict = {
-        'en': {'uri':'english', 'tag':'div', 'class':'def ddef_d db'},
-        'cn': {'uri':'english-chinese-simplified', 'tag':'div', 'class':'tc-bb tb lpb-25 break-cj'},
-    }
-
-    if language not in language_dict:
+    layout = LANGUAGE_DICT.get(language)
+    if layout is None:
         logging.error(f"Language '{language}' is not supported.")
         return None
 
-    url = f"https://dictionary.cambridge.org/dictionary/{language_dict[language]['uri']}/{formatted_word}"
+    # Cambridge entries rarely change, reuse what an earlier run found
+    cache_key = ('cambridge', word, language)
+    cached_info = CACHE.get(cache_key)
+    if cached_info is not None:
+        return cached_info
+
+    url = f"https://dictionary.cambridge.org/dictionary/{layout['uri']}/{formatted_word}"
 
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}    
 
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        response = await client.get(url, headers=headers)
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        # Hand the raw bytes to lxml rather than decoding the whole page to str first
+        html = response.content
+        encoding = response.encoding
+    except httpx.HTTPError as e:
         logging.error(f"Failed to fetch data from Cambridge: {e}")
         return None
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    
-    audio_url = None
+    # Parse only the first dictionary on the page, and the whole page if that has no definition
+    fragment = cambridge_page_fragment(html)
+    audio_tag, definition_tag, example_tags = find_word_info_tags(fragment, encoding, language)
+    if definition_tag is None and len(fragment) < len(html):
+        audio_tag, definition_tag, example_tags = find_word_info_tags(html, encoding, language)
 
     # Retrieve the audio URL
-    audio_tag = soup.find('source', {'type': 'audio/mpeg'})
-    
-    if audio_tag and 'src' in audio_tag.attrs:
-        audio_url = "https://dictionary.cambridge.org{}".format(audio_tag['src'])
+    audio_url = None
+    if audio_tag is not None and audio_tag.get('src'):
+        audio_url = "https://dictionary.cambridge.org{}".format(audio_tag.get('src'))
     
     # Retrieve the definition
-    # definition_tag = soup.find('div', {'class': 'def ddef_d db'})
-    definition_tag = soup.find(language_dict[language]['tag'], {'class': language_dict[language]['class']})
-    definition = definition_tag.text.strip().rstrip(':') if definition_tag else 'No definition found.'
+    definition = definition_tag.text_content().strip().rstrip(':') if definition_tag is not None else 'No definition found.'
     
     # Retrieve the examples
-    examples = []
-    example_tags = soup.find_all('div', {'class': 'examp dexamp'})
-    if example_tags:
-        # for example_tag in example_tags[:3]:  # Only keep the first three examples
-        #     example_text = example_tag.text.strip()
-        #     examples.append(example_text)
-        examples = [example_tag.text.strip() for example_tag in example_tags[:3]]
+    examples = [example_tag.text_content().strip() for example_tag in example_tags]
     
-    return {
+    word_info = {
         'audio_url': audio_url,
         'definition': definition,
         'examples': examples if examples else [] # Return empty list if no examples
     }
+    CACHE.set(cache_key, word_info, expire=CACHE_EXPIRE)
+    return word_info
 
-# Function to get TTS audio URL from VocalWare
+# Function to build the signed TTS audio URL for VocalWare
 def get_vocalware_tts_url(word):
     base_url = 'https://www.vocalware.com/tts/gen.php'
     params = {
-        'EID': 3,  # English UK, Hugh, Adult Male
-        'LID': 1,  # Language ID
-        'VID': 5,  # Voice ID
+        'EID': VW_EID,
+        'LID': VW_LID,
+        'VID': VW_VID,
         'TXT': word,
         'ACC': ACCOUNT_ID,
         'API': API_ID,
     }
-    
 
-    # Generate the hash
-    hash_string = (
-    str(params['EID']) +
-    str(params['LID']) +
-    str(params['VID']) +
-    str(params['TXT']) + 
-    str(params['ACC']) + 
-    str(params['API']) + 
-    SECRET_PHRASE  # This should NOT be URL-encoded
-    )
-
-    params['CS'] = hashlib.md5(hash_string.encode()).hexdigest()
-    
-    response = requests.get(base_url, params=params)
-    if response.status_code == 200:
-        return response.url
-    return None
-
-# Function to download audio file from URL with retries and User-Agent
-def download_audio(url, file_name):
-    session = requests.Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    
+    # Generate the hash: EID + LID + VID + TXT + ACC + API + secret
+    checksum = hashlib.md5(VW_HASH_PREFIX)
+    checksum.update(word.encode())
+    checksum.update(VW_HASH_SUFFIX)
+    params['CS'] = checksum.hexdigest()
+
+    return f"{base_url}?{urlencode(params)}"
+
+# Function to download audio bytes from URL with retries and User-Agent
+async def download_audio(session, url):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
     }
 
-    try:
-        response = session.get(url, headers=headers)
-        response.raise_for_status()
-        with open(file_name, 'wb') as file:
-            file.write(response.content)
-        return True
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download {url}: {e}")
-        return False
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                return await response.read()
+        except aiohttp.ClientConnectionError as e:
+            if attempt == DOWNLOAD_RETRIES:
+                print(f"Failed to download {url}: {e}")
+                return None
+            await asyncio.sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Failed to download {url}: {e}")
+            return None
 
-# Function to upload audio file to Anki and get the correct file name
-def upload_audio_to_anki(file_name):
-    try:
-        with open(file_name, 'rb') as file:
-            data = file.read()
-        b64_data = base64.b64encode(data).decode('utf-8')
-        payload = {
-            "action": "storeMediaFile",
-            "version": 6,
-            "params": {
-                "filename": file_name,
-                "data": b64_data
-            }
+# Function to build the AnkiConnect action that uploads an audio file
+def upload_audio_to_anki(file_name, data):
+    b64_data = base64.b64encode(data).decode('utf-8')
+    return {
+        "action": "storeMediaFile",
+        "version": 6,
+        "params": {
+            "filename": file_name,
+            "data": b64_data
         }
-        response = requests.post(ANKI_CONNECT_URL, json=payload).json()
-        if response.get('error') is not None:
-            print(f"Error uploading file {file_name}: {response['error']}")
-            return None
-        return response['result']
-    except Exception as e:
-        print(f"Exception uploading file {file_name}: {e}")
+    }
+
+# Function to send a batch of actions to AnkiConnect in a single "multi" request
+def send_anki_actions(actions):
+    payload = {
+        "action": "multi",
+        "version": 6,
+        "params": {
+            "actions": actions
+        }
+    }
+    try:
+        response = SESSION.post(ANKI_CONNECT_URL, json=payload).json()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to send {len(actions)} actions to AnkiConnect: {e}")
         return None
+    if response.get('error') is not None:
+        logging.error(f"Error sending {len(actions)} actions to AnkiConnect: {response['error']}")
+        return None
+    # Results come back in the same order as the actions
+    return response['result']
 
-def main(deck_name):
-    cards = get_cards(deck_name)
-    notes = get_notes(cards)
-    
-    processed_words = set()
-
-    for note in notes:
-        note_id = note['note']
-        word = note['fields']['Word']['value']
-        
-        # Check if Audio field already has a value
-        audio_field = note['fields'].get('Audio', {}).get('value', '')
-        if audio_field.strip():
-            # print(f"[-] Audio already exists for word: {word}, skipping...")
-            logging.info(f"Audio already exists for word: {word}, skipping...")
+# Error reported for one action of a "multi" request, if any
+def anki_action_error(result):
+    return result.get('error') if isinstance(result, dict) else None
+
+# Function to upload a batch of cards' audio, then fill in only the notes whose audio made it into Anki.
+# Returns whether each card's audio was uploaded.
+def send_anki_cards(cards):
+    upload_results = send_anki_actions([card['upload'] for card in cards])
+    if upload_results is None:
+        return [False] * len(cards)
+
+    uploaded = []
+    update_actions = []
+    for card, result in zip(cards, upload_results):
+        file_name = card['upload']['params']['filename']
+        error = anki_action_error(result)
+        uploaded.append(error is None)
+        if error is not None:
+            print(f"Error uploading file {file_name}: {error}")
             continue
+        # Point the note at the name Anki actually stored the file under
+        stored_name = result.get('result') if isinstance(result, dict) else result
+        update_actions.append(add_word_info_to_note(card['note_id'], stored_name or file_name, card['definition'], card['examples']))
+    if not update_actions:
+        return uploaded
+
+    update_results = send_anki_actions(update_actions)
+    if update_results is None:
+        return uploaded
+    for action, result in zip(update_actions, update_results):
+        note_id = action['params']['note']['id']
+        error = anki_action_error(result)
+        if error is not None:
+            logging.error(f"Error updating note {note_id}: {error}")
         else:
-            # print(f"[+] Download audio file for word '{word}'...")
-            logging.info(f"Making cards for word '{word}'...")
-
-        # Check if the word has already been processed
-        if word in processed_words:
-            # print(f"[-] Word '{word}' already processed, skipping...")
-            logging.info(f"Word '{word}' already processed, skipping...")
-            continue
-
-        # Use Cambridge by default then go to VocalWare
-        LANGUAGE = args.language
-        cambridge_word_info = get_cambridge_word_info(word, language=LANGUAGE)
+            logging.info(f"Note {note_id} successfully updated.")
+    return uploaded
+
+# Size of the base64 audio carried by one card
+def audio_payload_size(card):
+    return len(card['upload']['params']['data'])
+
+# Take the next batch of cards to send: up to ANKI_BATCH_SIZE cards and ANKI_BATCH_BYTES of audio
+def take_anki_batch(pending_cards):
+    batch = []
+    batch_bytes = 0
+    for card in pending_cards[:ANKI_BATCH_SIZE]:
+        size = audio_payload_size(card)
+        if batch and batch_bytes + size > ANKI_BATCH_BYTES:
+            break
+        batch.append(card)
+        batch_bytes += size
+    return batch, batch_bytes
+
+# Build the card for a single note
+async def process_note(lookup_sem, download_sem, client, session, note):
+    note_id = note['noteId']
+    word = note['fields']['Word']['value']
+    logging.info(f"Making cards for word '{word}'...")
+    return await build_card(lookup_sem, download_sem, client, session, note_id, word)
+
+# Fetch everything a note needs: the audio upload action plus the fields to fill in once it is stored
+async def build_card(lookup_sem, download_sem, client, session, note_id, word):
+    # Use Cambridge by default then go to VocalWare
+    async with lookup_sem:
+        cambridge_word_info = await get_cambridge_word_info(client, word, language=args.language)
+        if cambridge_word_info is None:
+            print(f"[-] Failed to look up word: {word}")
+            return None
         audio_url = cambridge_word_info['audio_url']
         word_definition = cambridge_word_info['definition']
         word_examples = cambridge_word_info['examples']
@@ -285,21 +405,108 @@ def main(deck_name):
             audio_url = get_vocalware_tts_url(word)
             file_name = "vocalware"
 
-        # audio_url = get_vocalware_tts_url(word)
-        # file_name = "vocalware"
-        
-        if audio_url:
-            # Generate a UUID for the file name
-            unique_filename = f"{file_name}-{uuid.uuid4()}.mp3"
-            if download_audio(audio_url, unique_filename):
-                audio_file_name = upload_audio_to_anki(unique_filename)
-                if audio_file_name:
-                    add_word_info_to_note(note_id, audio_file_name, word_definition, word_examples)
-                    processed_words.add(word)
+    if not audio_url:
+        print(f"[-] No audio found for word: {word}")
+        return None
+
+    audio_cache_key = hashlib.sha1(audio_url.encode()).hexdigest()
+    audio_data = CACHE.get(audio_cache_key)
+    if audio_data is None:
+        async with download_sem:
+            audio_data = await download_audio(session, audio_url)
+        if not audio_data:
+            return None
+        CACHE.set(audio_cache_key, audio_data, expire=CACHE_EXPIRE)
+    # Generate a UUID for the file name
+    unique_filename = f"{file_name}-{uuid.uuid4()}.mp3"
+    return {
+        'upload': upload_audio_to_anki(unique_filename, audio_data),
+        'word': word,
+        'note_id': note_id,
+        'definition': word_definition,
+        'examples': word_examples,
+    }
+
+async def main(deck_name):
+    # Only notes without audio come back, so finished notes are never fetched
+    note_ids = find_notes_without_audio(deck_name)
+    if note_ids is None:
+        return
+    notes = get_notes(note_ids)
+    if notes is None:
+        return
+
+    lookup_sem = asyncio.Semaphore(MAX_CONCURRENT_LOOKUPS)
+    download_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    # Cambridge lookups share HTTP/2 connections, audio downloads go through aiohttp
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+    connector = aiohttp.TCPConnector(limit=MAX_DOWNLOAD_CONNECTIONS, limit_per_host=MAX_DOWNLOAD_CONNECTIONS_PER_HOST)
+
+    # AnkiConnect handles one request at a time, so batches go to a single worker thread
+    # and are sent while the remaining notes are still being fetched
+    loop = asyncio.get_running_loop()
+    cards = []
+    cards_bytes = 0
+    note_tasks = {}  # running note task -> note
+    upload_tasks = {}  # running AnkiConnect batch -> its cards
+    # Words being worked on -> later notes with the same word. Those only run if the
+    # word's current attempt fails before its audio is uploaded to Anki.
+    waiting_notes = {}
+
+    with ThreadPoolExecutor(max_workers=1) as anki_executor:
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=5.0, follow_redirects=True) as client, \
+                aiohttp.ClientSession(connector=connector) as session:
+
+            def start_note(note):
+                note_tasks[asyncio.ensure_future(process_note(lookup_sem, download_sem, client, session, note))] = note
+
+            def word_finished(word, uploaded):
+                if uploaded:
+                    for note in waiting_notes.pop(word):
+                        logging.info(f"Word '{word}' already processed, skipping note {note['noteId']}...")
+                elif waiting_notes[word]:
+                    # Let the next note with the same word have another go
+                    start_note(waiting_notes[word].pop(0))
                 else:
-                    print(f"[-] Failed to upload audio for word: {word}")
-        else:
-            print(f"[-] No audio found for word: {word}")
+                    del waiting_notes[word]
+
+            for note in notes:
+                word = note['fields']['Word']['value']
+                if word in waiting_notes:
+                    waiting_notes[word].append(note)
+                else:
+                    waiting_notes[word] = []
+                    start_note(note)
+
+            while note_tasks or upload_tasks:
+                done, _ = await asyncio.wait({*note_tasks, *upload_tasks}, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task in note_tasks:
+                        note = note_tasks.pop(task)
+                        if task.exception() is not None:
+                            logging.error(f"Failed to process note {note['noteId']}: {task.exception()!r}")
+                        if task.exception() is None and task.result():
+                            cards.append(task.result())
+                            cards_bytes += audio_payload_size(task.result())
+                        else:
+                            word_finished(note['fields']['Word']['value'], uploaded=False)
+                    else:
+                        batch = upload_tasks.pop(task)
+                        if task.exception() is not None:
+                            logging.error(f"Failed to send {len(batch)} cards to AnkiConnect: {task.exception()!r}")
+                            uploaded = [False] * len(batch)
+                        else:
+                            uploaded = task.result()
+                        for card, card_uploaded in zip(batch, uploaded):
+                            word_finished(card['word'], card_uploaded)
+
+                # Upload audio and update notes ANKI_BATCH_SIZE notes (or ANKI_BATCH_BYTES of audio) at a time
+                while cards and (len(cards) >= ANKI_BATCH_SIZE or cards_bytes >= ANKI_BATCH_BYTES or not note_tasks):
+                    batch, batch_bytes = take_anki_batch(cards)
+                    cards = cards[len(batch):]
+                    cards_bytes -= batch_bytes
+                    upload_tasks[loop.run_in_executor(anki_executor, send_anki_cards, batch)] = batch
 
 if __name__ == "__main__":
-    main("Test")
+    asyncio.run(main("Test"))